@@ -4,27 +4,53 @@ import logging
 import math
 import random
 import time
+from typing import NamedTuple
 
 import matplotlib.pyplot as plt
-import numpy as np
 import torch as t
 import torch.nn as nn
 from torch import optim
+from torch.func import functional_call
 from torch.nn import utils
+from torch.utils.checkpoint import checkpoint
 
 logger = logging.getLogger(__name__)
 
+DEVICE = "cuda" if t.cuda.is_available() else "cpu"  # the whole rollout stays on this device
+DTYPE = t.float32  # every tensor in the rollout, the python float constants below stay float32 when mixed in
+
 # environment parameters
 
 FRAME_TIME = 1.0  # time interval, originally =0.1
 GRAVITY_ACCEL = -9.81/1000  # gravity constant       Make sure it's negative
 BOOST_ACCEL = 14.715/1000  # thrust constant
 
+# drag force, -0.5 * c * p * A * velocity^2, folded into one constant
+# c: coeff of drag  A: surface/cross sectional area v: velocity p= air density
+# c = 0.75 typical value for the drag coeff of a model rocket, from grc.nasa.gov
+# p = 1.29 density of air
+# A = 10.75 average diameter of rocket = 3.7 [m], from space.stackexchange.com
+DRAG_COEFF = (-0.5) * 0.75 * 1.29 * 10.75
+
+# distribution of initial states, state = [x, x_dot, y, y_dot, theta]
+INIT_MEAN = [0., 0., 1., 0., 0.]
+INIT_SCALE = [0.1, 0.1, 0.1, 0.1, 0.05]
+
 # # the following parameters are not being used in the sample code
 # PLATFORM_WIDTH = 0.25  # landing platform width
 # PLATFORM_HEIGHT = 0.06  # landing platform height
 # ROTATION_ACCEL = 20  # rotation constant
 
+# the state is kept as one (batch,) tensor per variable instead of a (batch, 5) matrix,
+# so every update below is a dense 1-D op with no column indexing or re-stacking
+
+class State(NamedTuple):
+    x: t.Tensor
+    vx: t.Tensor  # x_dot
+    y: t.Tensor
+    vy: t.Tensor  # y_dot
+    theta: t.Tensor
+
 # define system dynamics
 # Notes: 
 # 0. You only need to modify the "forward" function !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!   
@@ -33,60 +59,47 @@ BOOST_ACCEL = 14.715/1000  # thrust constant
 # 3. Do not use inplace operations, e.g., x += 1. Please see the following section for an example that does not work.
 
 class Dynamics(nn.Module):
+    # folded into the graph as constants when the module is scripted
+    __constants__ = ["dt", "thrust_dv", "gravity_dv", "drag"]
 
     def __init__(self):
         super(Dynamics, self).__init__()
+        self.dt = FRAME_TIME
+        self.thrust_dv = BOOST_ACCEL * FRAME_TIME
+        self.gravity_dv = GRAVITY_ACCEL * FRAME_TIME
 
-    @staticmethod
-    def forward(state, action):
+        self.drag = DRAG_COEFF  # applied only to the velocities x_dot, y_dot
+
+    def forward(self, state: State, action: t.Tensor) -> State:
 
         """
-        action: thrust or no thrust
-        state[0] = y
-        state[1] = y_dot
+        action[:, 0] = thrust
+        action[:, 1] = rotation
+        state = State(x, x_dot, y, y_dot, theta)
         """
+        x, vx, y, vy, theta = state
         
         # Apply gravity
-        # Note: Here gravity is used to change velocity which is the second element of the state vector
+        # Note: Here gravity is used to change velocity which is the fourth field of the state
         # Normally, we would do x[1] = x[1] + gravity * delta_time
         # but this is not allowed in PyTorch since it overwrites one variable (x[1]) that is part of the computational graph to be differentiated.
-        # Therefore, I define a tensor dx = [0., gravity * delta_time], and do x = x + dx. This is allowed... 
-        delta_state_gravity = t.tensor([0., 0., 0., GRAVITY_ACCEL * FRAME_TIME, 0.])
+        # Therefore every field below is rebuilt as a new tensor, e.g. vy = vy + gravity * delta_time. This is allowed... 
 
         # Thrust
         # Going off of what we talked about in lecture for including problem statement 
-        N= len(state)
-        
-        state_tensor= t.zeros((N, 5)) #setting matrix full of zeros
-        state_tensor[:, 1]= -t.sin(state[:, 4]) # Vx       
-        state_tensor[:, 3]= t.cos(state[:, 4])  # Vy 
-        
-        delta_state = BOOST_ACCEL * FRAME_TIME * t.mul(state_tensor, action[:, 0].reshape(-1, 1))
-        
-        #Theta
-        delta_state_theta= FRAME_TIME * t.mul(t.tensor([0., 0., 0., 0., -1.]), action[:, 1].reshape(-1, 1))
+        thrust = self.thrust_dv * action[:, 0]
 
-        # Update velocity   !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!     think I got it
-        state_copy = state # Don't think you can have inline operation 'state=state+...'
-        
-        # drag force, applying it directly to velocity, "state"
-        coeff= 0.75 # typical value for the drag coeff of a model rocket, from grc.nasa.gov
-        p= 1.29 # density of air
-        A= 10.75 # average diameter of rocket = 3.7 [m], from space.stackexchange.com
-        drag= (-0.5)*coeff*p*A # *velocity^2
-        # c: coeff of drag  A: surface/cross sectional area v: velocity p= air density
-        
-        state = state_copy + delta_state + delta_state_gravity + delta_state_theta + drag*state_copy**2 
+        # Update velocity, with drag opposing the direction of motion
+        vx = vx - thrust * t.sin(theta) + self.drag * vx * vx.abs()
+        vy = vy + thrust * t.cos(theta) + self.gravity_dv + self.drag * vy * vy.abs()
+
+        #Theta
+        theta = theta - self.dt * action[:, 1]
         
-        # Update state !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! Think I got it
-        # Note: Same as above. Use operators on matrices/tensors as much as possible. Do not use element-wise operators as they are considered inplace.
-        step_mat = t.tensor([[1., FRAME_TIME, 0., 0., 0.],
-                            [0., 1., 0., 0., 0.],
-                            [0., 0., 1., FRAME_TIME, 0.],
-                            [0., 0., 0., 1., 0.],
-                            [0., 0., 0., 0., 1.]])
-        state = t.matmul(step_mat, state)      
-        return state 
+        # Update position
+        x = x + self.dt * vx
+        y = y + self.dt * vy
+        return State(x, vx, y, vy, theta)
     
 # a deterministic controller
 # Note:
@@ -104,6 +117,7 @@ class Controller(nn.Module):
         dim_hidden: up to you
         """
         super(Controller, self).__init__()
+        self.dim_output = dim_output
         self.network = nn.Sequential(
             nn.Linear(dim_input, dim_hidden),
             nn.Tanh(),
@@ -122,42 +136,57 @@ class Controller(nn.Module):
 # Note:
 # 0. Need to change "initialize_state" to optimize the controller over a distribution of initial states   !!!!!
 # 1. self.action_trajectory and self.state_trajectory stores the action and state trajectories along time
+# 2. Each time step is checkpointed, so backward recomputes the step instead of keeping all of its intermediates
 
 class Simulation(nn.Module):
 
-    def __init__(self, controller, dynamics, T):
+    def __init__(self, controller, dynamics, T, batch_size):
         super(Simulation, self).__init__()
-        self.state = self.initialize_state()
+        # a scripted dynamics module recomputed by checkpoint crashes, or gives wrong gradients on its first call
+        self.checkpoint_steps = not isinstance(dynamics, t.jit.ScriptModule)
+        self.state = self.initialize_state(batch_size)
         self.controller = controller
         self.dynamics = dynamics
         self.T = T
-        self.action_trajectory = []
-        self.state_trajectory = []
+        # allocated once and reused by every closure call
+        self.action_trajectory = t.empty(T, batch_size, controller.dim_output, device=DEVICE, dtype=DTYPE)
+        # one (T, batch) trajectory per state field
+        self.state_trajectory = State(*t.empty(len(self.state), T, batch_size, device=DEVICE, dtype=DTYPE))
 
     def forward(self, state):
-        self.action_trajectory = []
-        self.state_trajectory = []
-        for _ in range(T):
-            action = self.controller.forward(state)
-            state = self.dynamics.forward(state, action)
-            self.action_trajectory.append(action)
-            self.state_trajectory.append(state)
+        for i in range(self.T):
+            if self.checkpoint_steps:
+                state, action = checkpoint(self.step, state, use_reentrant=False)
+            else:
+                state, action = self.step(state)
+            self.action_trajectory[i] = action.detach()
+            for trajectory, value in zip(self.state_trajectory, state):
+                trajectory[i] = value.detach()
         return self.error(state)
 
+    def step(self, state):
+        # the controller still sees the full state vector
+        action = self.controller(t.stack(state, dim=1))
+        return self.dynamics(state, action), action
+
     @staticmethod
-    def initialize_state():
-        state = [0., 0., 1., 0., 0.]  # TODO: need batch of initial states   !!!!!!!!!!!!!!!!!!!! 
-        return t.tensor(state, requires_grad=False).float()
+    def initialize_state(batch_size):
+        # sampled once so every closure call sees the same batch, then split into one contiguous tensor per field
+        scale = t.tensor(INIT_SCALE, device=DEVICE, dtype=DTYPE)[:, None]
+        mean = t.tensor(INIT_MEAN, device=DEVICE, dtype=DTYPE)[:, None]
+        state = t.randn(5, batch_size, device=DEVICE, dtype=DTYPE) * scale + mean
+        return State(*state.requires_grad_(False))
 
     def error(self, state):
-        return state[0]**2 + state[1]**2    
+        # terminal altitude and vertical speed of every initial state, plus a small penalty on the final angle, averaged in one reduction
+        return (state.y**2 + state.vy**2 + 0.1 * state.theta**2).mean()    
     
 # set up the optimizer
 # Note:
 # 0. LBFGS is a good choice if you don't have a large batch size (i.e., a lot of initial states to consider simultaneously)
 # 1. You can also try SGD and other momentum-based methods implemented in PyTorch
 # 2. You will need to customize "visualize"     !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-# 3. loss.backward is where the gradient is calculated (d_loss/d_variables)
+# 3. t.autograd.grad is where the gradient is calculated (d_loss/d_variables), the loss is a pure function of the parameters
 # 4. self.optimizer.step(closure) is where gradient descent is done
 
         # t.autograd.set_detect_anomaly(True)  #used to help identify error TW 
@@ -165,32 +194,49 @@ class Simulation(nn.Module):
         #       don't think I need this anymore
 
 class Optimize:
-    def __init__(self, simulation):
+    def __init__(self, simulation, compile_loss=True):
         self.simulation = simulation
-        self.parameters = simulation.controller.parameters()
-        self.optimizer = optim.LBFGS(self.parameters, lr=0.5)  
+        # traced once, line search probes then only swap in the new parameter values instead of rebuilding the rollout
+        # default mode: reduce-overhead (CUDA graph replay) hasn't been checked on a gpu with the in-place trajectory writes
+        self.loss_fn = t.compile(self.loss, dynamic=False) if compile_loss else self.loss
+        self.parameters = dict(simulation.named_parameters())
+        self.optimizer = optim.LBFGS(self.parameters.values(), lr=1.0, max_iter=10, history_size=10,
+                                     tolerance_grad=1e-7, tolerance_change=1e-9, line_search_fn="strong_wolfe")
         # originally: lr=0.01 took 28 iter, 21 iter at 0.1, 25 iter at 0.001, 20 iter at 0.5
+        # the strong Wolfe line search picks the step length, so lr no longer needs tuning
+
+    def loss(self, params, state):
+        return functional_call(self.simulation, params, (state,))
 
     def step(self):
         def closure():
-            loss = self.simulation(self.simulation.state)
-            self.optimizer.zero_grad()
-            loss.backward()                                     
-            return loss
+            loss = self.loss_fn(self.parameters, self.simulation.state)
+            grads = t.autograd.grad(loss, tuple(self.parameters.values()))
+            for p, g in zip(self.parameters.values(), grads):
+                p.grad = g
+            return loss.detach()
         self.optimizer.step(closure)
         return closure()
     
     def train(self, epochs):
         for epoch in range(epochs):
             loss = self.step()
-            self.visualize()
-
-    def visualize(self):
-        data = np.array([self.simulation.state_trajectory[i].detach().numpy() for i in range(self.simulation.T)])
-        x = data[:, 0]
-        y = data[:, 1]
-        plt.plot(x, y)   
-        plt.show()
+            self.visualize(epoch, last=epoch == epochs - 1)
+        plt.show()  # keep the final trajectory on screen once training is done
+
+    def visualize(self, epoch, last=False, every=10):
+        if epoch % every != 0 and not last:
+            return
+        trajectory = self.simulation.state_trajectory  # already detached, only copied off the device here
+        # each field is its own contiguous (T, batch) tensor, so on the cpu .numpy() is a view, not a copy
+        x = trajectory.y.cpu().numpy()  # one line per initial state
+        y = trajectory.vy.cpu().numpy()
+        plt.clf()
+        plt.plot(x, y, linewidth=0.5, alpha=0.3)   
+        plt.plot(x.mean(axis=1), y.mean(axis=1), "k", linewidth=2)  # mean trajectory over the batch
+        plt.title("epoch %d" % epoch)
+        plt.draw()
+        plt.pause(0.001)  # non-blocking, unlike plt.show()
         
         
 # Now it's time to run the code!
@@ -198,10 +244,14 @@ class Optimize:
 T = 20  # number of time steps      originally, T=100
 dim_input = 5  # state space dimensions     = #of initial states (line 144)   
 dim_hidden = 6  # latent dimensions
-dim_output = 1  # action space dimensions
-d = Dynamics()  # define dynamics
-c = Controller(dim_input, dim_hidden, dim_output)  # define controller
-s = Simulation(c, d, T)  # define simulation
-o = Optimize(s)  # define optimizer
+dim_output = 2  # action space dimensions     = thrust, rotation
+batch_size = 64  # number of initial states
+use_compile = True  # False: TorchScript the dynamics instead, much quicker to warm up than torch.compile (t.jit.script is deprecated in recent PyTorch)
+d = Dynamics().to(DEVICE, DTYPE)  # define dynamics
+c = Controller(dim_input, dim_hidden, dim_output).to(DEVICE, DTYPE)  # define controller
+if not use_compile:  # otherwise the whole rollout, controller and dynamics included, is compiled by Optimize
+    d = t.jit.script(d)  # controller stays eager, functional_call can't swap the parameters of a scripted module
+s = Simulation(c, d, T, batch_size)  # define simulation
+o = Optimize(s, use_compile)  # define optimizer
 o.train(40)  # solve the optimization problem   originally =40 
                   